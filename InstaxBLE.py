@@ -362,8 +362,8 @@ class InstaxBLE:
 
     def print_image(self, imgSrc):
         """
-        print an image. Either pass a path to an image (as a string) or pass
-        the bytearray to print directly
+        print an image. Either pass a path to an image (as a string), a PIL
+        image, or pass the bytearray to print directly
         """
         self.log(f'printing image "{imgSrc}"')
         if self.photosLeft == 0 and not self.dummyPrinter:
@@ -374,6 +374,8 @@ class InstaxBLE:
         if isinstance(imgSrc, str):  # if it's a path, load the image contents
             image = Image.open(imgSrc)
             imgData = self.pil_image_to_bytes(image, max_size_kb=105)
+        elif isinstance(imgSrc, Image.Image):
+            imgData = self.pil_image_to_bytes(imgSrc, max_size_kb=105)
         elif isinstance(imgSrc, BytesIO):
             imgSrc.seek(0)  # Go to the start of the BytesIO object
             image = Image.open(imgSrc)
@@ -7,6 +7,30 @@ except ImportError:
     raise ImportError("Pillow library not found. Please install it using: pip install Pillow")
 
 import io
+import signal
+
+# Bound once at module level, these are looked up for every image processed
+_Image_open = Image.open
+_BytesIO = io.BytesIO
+_BILINEAR = Image.Resampling.BILINEAR
+
+
+def warm_up():
+    """
+    Encode and decode a tiny JPEG, so Pillow and its codec libraries are
+    loaded before the first real image. Used as the initializer of the
+    worker processes.
+
+    Also makes the worker ignore Ctrl-C, the main process shuts the pool down.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    buffer = _BytesIO()
+    Image.new('RGB', (1, 1)).save(buffer, format='JPEG')
+    buffer.seek(0)
+    with _Image_open(buffer) as image:
+        image.load()
+
 
 def crop_and_resize_image(target_x, target_y, image_bytes):
     """
@@ -18,39 +42,71 @@ def crop_and_resize_image(target_x, target_y, image_bytes):
         image_bytes (bytes): The byte array representing the image.
 
     Returns:
-        bytes: The processed image as a byte array.
+        PIL.Image.Image: The processed image. It is not encoded, so the caller
+        can encode it once in the format the printer needs.
     """
     # Open the image from the byte array
-    image = Image.open(io.BytesIO(image_bytes))
+    return _crop_and_resize(_Image_open(_BytesIO(image_bytes)), target_x, target_y)
+
+
+def crop_and_resize_image_path(target_x, target_y, path):
+    """
+    Crops and resizes an image file to the target resolution while maintaining aspect ratio.
+    Same as crop_and_resize_image, but lets Pillow read the file itself instead
+    of loading all of it into memory first.
+
+    Args:
+        target_x (int): The target width of the image.
+        target_y (int): The target height of the image.
+        path (str): The path to the image file.
+
+    Returns:
+        PIL.Image.Image: The processed image.
+    """
+    # Close the file when done, so it can be moved afterwards (on Windows)
+    with _Image_open(path) as image:
+        return _crop_and_resize(image, target_x, target_y)
 
-    # Calculate the target aspect ratio
-    target_aspect = target_x / target_y
 
-    # Calculate the current aspect ratio
-    current_aspect = image.width / image.height
+def _crop_and_resize(image, target_x, target_y):
+    """ Crop and resize an opened (not yet loaded) image, see crop_and_resize_image """
+    # Let libjpeg scale down by 1/2, 1/4 or 1/8 while decoding, this skips most
+    # of the work for large photos. The result stays at least twice the
+    # target size so there is enough left to crop from. No-op for other formats.
+    image.draft('RGB', (target_x * 2, target_y * 2))
 
-    # Crop the image to the target aspect ratio
-    if current_aspect > target_aspect:
+    # Compare the aspect ratios by cross-multiplying, so all of the crop
+    # geometry stays in integers (width / height > target_x / target_y)
+    if image.width * target_y > image.height * target_x:
         # Image is wider than the target aspect ratio, so crop the width
-        new_width = int(target_aspect * image.height)
-        left = (image.width - new_width) / 2
+        new_width = image.height * target_x // target_y
+        left = (image.width - new_width) // 2
         top = 0
         right = left + new_width
         bottom = image.height
         cropped_image = image.crop((left, top, right, bottom))
     else:
         # Image is taller than or equal to the target aspect ratio, so crop the height
-        new_height = int(image.width / target_aspect)
+        new_height = image.width * target_y // target_x
         left = 0
-        top = (image.height - new_height) / 2
+        top = (image.height - new_height) // 2
         right = image.width
         bottom = top + new_height
         cropped_image = image.crop((left, top, right, bottom))
 
-    # Scale the cropped image to the target resolution
-    resized_image = cropped_image.resize((target_x, target_y))
+    # The printer only takes JPEGs, so get rid of palettes and alpha channels
+    if cropped_image.mode != 'RGB':
+        cropped_image = cropped_image.convert('RGB')
+
+    # Reduce the cropped image close to the target size first, thumbnail uses
+    # a fast box reduction when the image is more than twice as large
+    cropped_image.thumbnail((target_x, target_y))
+
+    # Nothing left to do if the image already has the target resolution
+    if cropped_image.size == (target_x, target_y):
+        return cropped_image
 
-    # Save the processed image to a byte array
-    output_buffer = io.BytesIO()
-    resized_image.save(output_buffer, format='PNG') # Use a consistent format for testing
-    return output_buffer.getvalue()
+    # Scale the cropped image to the target resolution. Bilinear is plenty
+    # for the last few pixels of a print this size, and faster than the
+    # bicubic filter Pillow uses by default.
+    return cropped_image.resize((target_x, target_y), _BILINEAR)
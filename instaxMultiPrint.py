@@ -2,13 +2,413 @@
 #
 # A Python script for Windows that monitors a given path.
 # It ensures 'printed' and 'error' sub-folders exist
-# and then enters an endless loop processing image files.
+# and then processes image files as they appear in the folder.
 
+import errno
+import importlib
 import sys
 import os
-import time
+import queue
 import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from heapq import nsmallest
+from operator import itemgetter
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # Fall back to polling the directory, see DirectoryPoller
+    Observer = None
+    FileSystemEventHandler = object
+
+from InstaxBLE import InstaxBLE
+import LedPatterns
+
+# The file name isn't a valid identifier, so it can't be imported by name
+helpers = importlib.import_module('helper-functions')
+
+IMAGE_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp'})
+
+# Maximum number of files DirectoryPoller queues per scan
+POLL_BATCH_SIZE = 16
+
+
+def scan_images(target_dir):
+    """
+    List the image files in a directory together with their modification time.
+
+    os.scandir caches the file type and (on Windows) the stat data from the
+    directory read, and the extension is checked first so only image files
+    are ever stat'ed.
+
+    Args:
+        target_dir (str): The directory to scan.
+
+    Returns:
+        list: (path, mtime) tuples, in directory order.
+    """
+    files_with_mtime = []
+    with os.scandir(target_dir) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTS:
+                continue
+            try:
+                # Only consider files, not sub-directories
+                if entry.is_file(follow_symlinks=False):
+                    files_with_mtime.append((entry.path, entry.stat().st_mtime))
+            except OSError:
+                # File might have been moved/deleted just as we check it
+                continue
+    return files_with_mtime
+
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    _kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    _kernel32.CreateFileW.argtypes = (wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                      wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE)
+    _kernel32.CreateFileW.restype = wintypes.HANDLE
+    _kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+
+    _GENERIC_READ = 0x80000000
+    _OPEN_EXISTING = 3
+    _INVALID_HANDLE_VALUE = wintypes.HANDLE(-1).value
+    _ERROR_FILE_NOT_FOUND = 2
+    _ERROR_PATH_NOT_FOUND = 3
+    _ERROR_SHARING_VIOLATION = 32
+
+    def _is_file_ready(path):
+        """
+        Check if no other process has the file open, by opening it without
+        sharing. Raises FileNotFoundError if the file is gone.
+        """
+        handle = _kernel32.CreateFileW(path, _GENERIC_READ, 0, None, _OPEN_EXISTING, 0, None)
+        if handle == _INVALID_HANDLE_VALUE:
+            error = ctypes.get_last_error()
+            if error == _ERROR_SHARING_VIOLATION:
+                return False
+            if error in (_ERROR_FILE_NOT_FOUND, _ERROR_PATH_NOT_FOUND):
+                raise FileNotFoundError(error, ctypes.FormatError(error), path)
+            raise ctypes.WinError(error)
+        _kernel32.CloseHandle(handle)
+        return True
+
+else:
+    # path -> (size, time) of the first reading, see _is_file_ready
+    _first_sizes = {}
+
+    def _is_file_ready(path, interval=0.5):
+        """
+        Check if the file is done being written. POSIX has no mandatory locks,
+        so the file is considered ready once its size stayed the same for
+        <interval> seconds. Doesn't wait itself: the first call records the
+        size and returns False, check again later to compare.
+        Raises FileNotFoundError if the file is gone.
+        """
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            _first_sizes.pop(path, None)
+            raise
+
+        now = time.monotonic()
+        first = _first_sizes.get(path)
+        if first is None or first[0] != size:
+            _first_sizes[path] = (size, now)
+            return False
+        if now - first[1] < interval:
+            return False
+        del _first_sizes[path]
+        return True
+
+
+# Next counter to try per destination, so repeated names don't have to
+# probe every earlier "_1", "_2", ... again
+_last_counter = {}
+
+
+def move_to_unique_path(file_path, dest_dir):
+    """
+    Move a file into dest_dir without overwriting anything already there.
+
+    The new name is reserved with O_CREAT | O_EXCL, so the check and the
+    creation are a single atomic call, even with several watchers running.
+
+    Args:
+        file_path (str): The file to move.
+        dest_dir (str): The directory to move it to.
+
+    Returns:
+        str: The path the file was moved to.
+    """
+    basename = os.path.basename(file_path)
+    base, ext = os.path.splitext(basename)
+    key = os.path.join(dest_dir, basename)
+    counter = _last_counter.get(key, 0)
+
+    while True:
+        # If "image.jpg" exists, try "image_1.jpg", then "image_2.jpg"
+        name = basename if counter == 0 else f"{base}_{counter}{ext}"
+        dest_path = os.path.join(dest_dir, name)
+        try:
+            fd = os.open(dest_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            break
+        except FileExistsError:
+            counter += 1
+
+    os.close(fd)
+    _last_counter[key] = counter + 1
+
+    try:
+        # Replaces the empty placeholder we just created. 'printed' and
+        # 'error' live inside the watched folder, so this is a single rename.
+        try:
+            os.replace(file_path, dest_path)
+        except OSError as e:
+            # ...unless one of them is a mount point or link to another drive
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(file_path, dest_path)
+    except OSError:
+        os.remove(dest_path)
+        raise
+    return dest_path
+
+
+def send_led_patterns(instax):
+    """
+    Set a rainbow effect to be shown while printing and a pulsating green
+    effect when printing is done. Meant to run in a background thread
+    during startup.
+
+    Each pattern is still its own write and waits for its own reply. The
+    printer protocol might allow both to be sent in a single GATT write,
+    which InstaxBLE doesn't support yet.
+    """
+    try:
+        instax.send_led_pattern(LedPatterns.rainbow, when=1)
+        instax.send_led_pattern(LedPatterns.pulseGreen, when=2)
+    except Exception as e:
+        print(f"Error sending LED patterns: {e}", file=sys.stderr)
+
+
+def start_pool(max_workers):
+    """
+    Create the worker processes that crop and resize the images.
+
+    Args:
+        max_workers (int): The number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: The pool, with its workers starting up.
+    """
+    pool = ProcessPoolExecutor(max_workers=max_workers, initializer=helpers.warm_up)
+    # Workers are only started when work is submitted, so submit a trivial
+    # job for each to have them started (and warmed up) before the first image
+    for _ in range(max_workers):
+        pool.submit(os.getpid)
+    return pool
+
+
+def wait_for_reply(instax, timeout=5):
+    """
+    Block until the printer replied to the last packet that was sent.
+
+    Raises:
+        ConnectionError: If the printer disconnects while we wait.
+        TimeoutError: If the printer didn't reply within <timeout> seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while instax.waitingForResponse:
+        if not instax.peripheral.is_connected():
+            raise ConnectionError("Printer disconnected")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Printer didn't reply within {timeout} seconds")
+        time.sleep(0.05)
+
+
+def restart_pool(pool, max_workers, in_flight, image_size):
+    """
+    Replace a pool whose workers crashed, and resubmit the images that
+    weren't finished yet (they're still on disk).
+
+    Args:
+        pool (ProcessPoolExecutor): The broken pool.
+        max_workers (int): The number of worker processes.
+        in_flight (deque): (file_path, future) pairs, updated in place.
+        image_size (tuple): The (width, height) to crop and resize to.
+
+    Returns:
+        ProcessPoolExecutor: The new pool.
+    """
+    pool.shutdown(wait=False)
+    pool = start_pool(max_workers)
+    for index, (file_path, future) in enumerate(in_flight):
+        # Futures of a broken pool all end with BrokenProcessPool
+        if not future.done() or future.exception() is not None:
+            in_flight[index] = (file_path, pool.submit(helpers.crop_and_resize_image_path, *image_size, file_path))
+    return pool
+
+
+def refresh_printer_status(instax):
+    """
+    Request the printer's status (photos left, charging) and wait for the reply.
+    Raises the same errors as wait_for_reply.
+    """
+    # send_packet() would wait for an outstanding reply without a time limit
+    wait_for_reply(instax)
+    instax.get_printer_status()
+    wait_for_reply(instax)
+
+
+def wait_for_print(instax, timeout=120):
+    """
+    Block until all packets of the current print job have been sent.
+    print_image() only sends the first packet, the notification handler
+    sends the rest as the printer acknowledges them.
+
+    Raises:
+        ConnectionError: If the printer disconnects before everything was sent.
+        TimeoutError: If the packets weren't sent within <timeout> seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while instax.packetsForPrinting and not instax.cancelled:
+        if not instax.peripheral.is_connected():
+            raise ConnectionError("Printer disconnected while sending the image")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Image wasn't sent within {timeout} seconds")
+        time.sleep(0.1)
+
+
+class PendingFiles:
+    """
+    Queue of files to check, which holds each path at most once. Writing a
+    large file triggers many events, this way they result in a single
+    check (or a single scheduled retry) instead of one per event.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        # Paths that are queued, or waiting for a retry
+        self.paths = set()
+        self.lock = threading.Lock()
+
+    def _claim(self, path):
+        """ Mark path as pending, returns False if it already was """
+        with self.lock:
+            if path in self.paths:
+                return False
+            self.paths.add(path)
+            return True
+
+    def put(self, path):
+        if self._claim(path):
+            self.queue.put(path)
+
+    def retry_later(self, path, delay=1):
+        """ Queue path again after <delay> seconds """
+        if self._claim(path):
+            retry = threading.Timer(delay, self.queue.put, args=(path,))
+            retry.daemon = True
+            retry.start()
+
+    def get(self, timeout=None):
+        """ Take the next path, raises queue.Empty after <timeout> seconds """
+        path = self.queue.get(timeout=timeout)
+        with self.lock:
+            self.paths.discard(path)
+        return path
+
+    def empty(self):
+        return self.queue.empty()
+
+
+class ImageEventHandler(FileSystemEventHandler):
+    """
+    Pushes the path of every created, modified or moved-in file onto a queue,
+    so the main loop only wakes up when something actually changed.
+    """
+
+    def __init__(self, pending, target_dir):
+        super().__init__()
+        self.pending = pending
+        # Event paths might use the resolved path of the folder (e.g. on macOS)
+        self.target_dirs = {target_dir, os.path.realpath(target_dir)}
+
+    def _put(self, path):
+        # Some emitters (FSEvents) still report files moved out of the folder
+        # on a non-recursive watch, like our own moves into 'printed'
+        if os.path.dirname(path) in self.target_dirs:
+            self.pending.put(path)
 
+    def on_created(self, event):
+        if not event.is_directory:
+            self._put(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._put(event.src_path)
+
+    def on_closed(self, event):
+        # Only emitted on Linux (inotify), when a writer closes the file
+        if not event.is_directory:
+            self._put(event.src_path)
+
+    def on_moved(self, event):
+        # e.g. downloads that are renamed from a temporary name when complete
+        if not event.is_directory:
+            self._put(event.dest_path)
+
+
+class DirectoryPoller(threading.Thread):
+    """
+    Fallback for ImageEventHandler when watchdog isn't installed. Scans the
+    directory and pushes new or changed image files onto the queue, oldest
+    first. The interval starts at 100ms and doubles up to 5s while nothing
+    changes, so an idle folder costs next to nothing and a busy one is
+    still picked up quickly.
+    """
+
+    def __init__(self, target_dir, pending):
+        super().__init__(daemon=True)
+        self.target_dir = target_dir
+        self.pending = pending
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        seen = {}
+        idle_interval = 0.1
+        while not self.stopped.is_set():
+            try:
+                files_with_mtime = scan_images(self.target_dir)
+            except OSError as e:
+                print(f"Error reading directory '{self.target_dir}': {e}", file=sys.stderr)
+                files_with_mtime = []
+
+            # Only the oldest few are queued, the rest follow on the next scans
+            new_files = nsmallest(POLL_BATCH_SIZE, (f for f in files_with_mtime if seen.get(f[0]) != f[1]), key=itemgetter(1))
+            for file_path, _ in new_files:
+                self.pending.put(file_path)
+
+            # Forget files that are gone, so they're picked up again if they return
+            seen = {path: mtime for path, mtime in files_with_mtime if seen.get(path) == mtime}
+            seen.update(new_files)
+
+            if new_files:
+                idle_interval = 0.1
+            else:
+                idle_interval = min(idle_interval * 2, 5.0)
+            self.stopped.wait(idle_interval)
 
 
 def main(args):
@@ -98,8 +498,16 @@ def main(args):
     try:
         instax = InstaxBLE(print_enabled=True, quiet=True)
         instax.connect()
-        instax.send_led_pattern(LedPatterns.rainbow, when=1)
-        instax.send_led_pattern(LedPatterns.pulseGreen, when=2)
+        # connect() doesn't raise when it fails, so check that we're connected
+        # and that the printer told us which image size it needs
+        if not instax.peripheral or not instax.peripheral.is_connected() or instax.imageSize == (0, 0):
+            print("Error: Could not connect to the printer.", file=sys.stderr)
+            instax.disconnect()
+            return 1
+        # Send the LED patterns in the background, so the directory is
+        # scanned while we wait for the printer to acknowledge them
+        led_thread = threading.Thread(target=send_led_patterns, args=(instax,), daemon=True)
+        led_thread.start()
     except Exception as e:
         print(f"Error initializing InstaxBLE or connecting: {e}", file=sys.stderr)
         if instax:
@@ -112,93 +520,176 @@ def main(args):
 
 
 
-    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
-
+    # Everything from here on is cleaned up by the same 'finally', including
+    # a Ctrl-C during startup
+    observer = None
+    pool = None
     try:
-        while True:
+        # --- 6. Start watching the directory ---
+
+        # File system events are pushed onto this queue by the observer thread,
+        # the main thread blocks on it instead of polling the directory.
+        pending = PendingFiles()
+
+        if Observer is None:
+            print("watchdog is not installed, polling the directory for changes instead.")
+            observer = DirectoryPoller(target_dir, pending)
+            # The poller's first scan picks up the existing files
+            observer.start()
+        else:
+            observer = Observer()
+            # Not recursive, so files moved into 'printed' and 'error' are ignored
+            observer.schedule(ImageEventHandler(pending, target_dir), target_dir, recursive=False)
 
-            # --- 1. Read the directory ---
-            files_with_mtime = []
             try:
-                for f in os.listdir(target_dir):
-                    file_path = os.path.join(target_dir, f)
-                    try:
-                        # Only consider files, not sub-directories
-                        if os.path.isfile(file_path):
-                            mtime = os.path.getmtime(file_path)
-                            files_with_mtime.append((file_path, mtime))
-                    except (OSError, FileNotFoundError):
-                        # File might have been moved/deleted just as we check it
-                        continue
-            except Exception as e:
+                observer.start()
+            except OSError as e:
+                print(f"Error watching directory '{target_dir}': {e}", file=sys.stderr)
+                return 1
+
+            # Queue the files that were already there before we started watching,
+            # sorted by modification date (oldest first)
+            try:
+                files_with_mtime = scan_images(target_dir)
+            except OSError as e:
                 print(f"Error reading directory '{target_dir}': {e}", file=sys.stderr)
-                # Wait before retrying to avoid spamming errors
-                time.sleep(5)
-                continue
+                files_with_mtime = []
 
-            # --- 2. Sort the list by modification date (oldest first) ---
-            files_with_mtime.sort(key=lambda x: x[1])
-            sorted_files = [f[0] for f in files_with_mtime]
+            files_with_mtime.sort(key=itemgetter(1))
+            for file_path, _ in files_with_mtime:
+                pending.put(file_path)
 
-            # --- 3. Filter for image files ---
-            image_files = [f for f in sorted_files if f.lower().endswith(IMAGE_EXTENSIONS)]
+        # --- 7. Start the image workers ---
 
-            if image_files:
-                print(f"Found {len(image_files)} image(s) to process...")
+        # Cropping and resizing is done in worker processes, so the next images
+        # are already prepared while the current one is being sent to the printer.
+        max_workers = min(4, os.cpu_count() or 1)
+        pool = start_pool(max_workers)
+        # (file_path, future) pairs, oldest first
+        in_flight = deque()
+        # How often the worker preparing a file crashed, per file. After the
+        # second time the image itself is the likely cause.
+        crashes = {}
 
-            # --- 4. Iterate over the list of files ---
-            for file_path in image_files:
+        # Printing shares the BLE connection, so the LED patterns have to be sent first
+        led_thread.join()
+
+        while True:
+
+            # --- 1. Print the oldest prepared image ---
+            # Done once every worker is busy and one more image is prepared
+            # (or being prepared), or when no other files are waiting
+            if in_flight and (len(in_flight) > max_workers or pending.empty()):
+                file_path, future = in_flight.popleft()
+                basename = os.path.basename(file_path)
+                print(f"Printing: {basename}")
 
-                # Check if file is not being used
-                in_use = True
                 try:
-                    # On Windows, trying to rename a file to itself will
-                    # raise PermissionError if the file is locked.
-                    os.rename(file_path, file_path)
-                    in_use = False
-                except PermissionError:
-                    print(f"Skipping '{os.path.basename(file_path)}': File is in use.")
-                except FileNotFoundError:
-                    print(f"Skipping '{os.path.basename(file_path)}': File was moved or deleted.")
-                    continue  # File is gone, move to the next
-                except OSError as e:
-                    print(f"Skipping '{os.path.basename(file_path)}': OS error ({e}).")
-
-                # If it is not in use, process it
-                if not in_use:
-                    basename = os.path.basename(file_path)
-                    print(f"Processing: {basename}")
-
-                    # Ensure a unique name is assigned upon moving
-                    base, ext = os.path.splitext(basename)
-                    counter = 1
-                    dest_path = os.path.join(printed_dir, basename)
-
-                    while os.path.exists(dest_path):
-                        # If "image.jpg" exists, try "image_1.jpg", then "image_2.jpg"
-                        dest_path = os.path.join(printed_dir, f"{base}_{counter}{ext}")
-                        counter += 1
-
-                    # Move the file
+                    image = future.result()
+                except BrokenProcessPool:
+                    crashes[file_path] = crashes.get(file_path, 0) + 1
+                    if crashes[file_path] < 2:
+                        # Not necessarily this image's fault, try it (and the
+                        # others) again with new workers
+                        in_flight.appendleft((file_path, future))
+                        print("Image worker crashed, restarting the workers.", file=sys.stderr)
+                        pool = restart_pool(pool, max_workers, in_flight, instax.imageSize)
+                        continue
+                    print(f"Error preparing '{basename}': image worker crashed twice", file=sys.stderr)
+                    image = None
+                except Exception as e:
+                    # Something is wrong with the image itself
+                    print(f"Error preparing '{basename}': {e}", file=sys.stderr)
+                    image = None
+
+                crashes.pop(file_path, None)
+
+                if image is None:
+                    dest_dir = error_dir
+                else:
                     try:
-                        shutil.move(file_path, dest_path)
-                        print(f"Moved to: {os.path.basename(dest_path)}")
+                        # The status from the previous print might not be in yet
+                        refresh_printer_status(instax)
+                        # print_image() only logs this, and would return without printing
+                        if instax.photosLeft == 0:
+                            raise RuntimeError("No photos left in the printer")
+                        instax.print_image(image)
+                        wait_for_print(instax)
                     except Exception as e:
-                        print(f"Error moving '{basename}': {e}", file=sys.stderr)
-                        # If moving fails, we'll just skip it for this iteration.
-                        # We could move it to 'error_dir' here if needed.
+                        # Not the image's fault, so leave it (and everything after it)
+                        # where it is. Nothing reconnects, so there's no point going on.
+                        print(f"Error printing '{basename}': {e}", file=sys.stderr)
+                        print("Stopping, the remaining files were left in place. "
+                              "Restart the script once the printer is ready.", file=sys.stderr)
+                        return 1
+                    dest_dir = printed_dir
+
+                # Move the file
+                try:
+                    dest_path = move_to_unique_path(file_path, dest_dir)
+                    print(f"Moved to: {os.path.basename(dest_path)}")
+                except Exception as e:
+                    print(f"Error moving '{basename}': {e}", file=sys.stderr)
+                    # If moving fails, we'll just skip it for this iteration.
+                continue
+
+            # --- 2. Wait for the next file ---
+            # A timeout is used so Ctrl-C is still handled on Windows, where a
+            # blocking Queue.get() can't be interrupted.
+            try:
+                file_path = pending.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            # --- 3. Filter for image files ---
+            if os.path.splitext(file_path)[1].lower() not in IMAGE_EXTS:
+                continue
 
-                # Wait 1 sec and continue the iteration
-                time.sleep(1)
+            # Several events can arrive for the same file
+            if any(path == file_path for path, _ in in_flight):
+                continue
+
+            # --- 4. Check if file is not being used ---
+            # On POSIX the first check of a file never passes, it's
+            # confirmed by the retry below.
+            in_use = True
+            try:
+                in_use = not _is_file_ready(file_path)
+            except FileNotFoundError:
+                # Already moved, or a duplicate event for a file we processed
+                continue
+            except OSError as e:
+                print(f"Skipping '{os.path.basename(file_path)}': OS error ({e}).")
 
-            # After processing all files, wait 1 second before scanning again
-            # This is the main polling interval.
-            time.sleep(1)
+            if in_use:
+                # The writer might not trigger another event once it's done,
+                # so try this file again a bit later
+                pending.retry_later(file_path, 0.5)
+                continue
+
+            # --- 5. Hand the file to a worker ---
+            print(f"Processing: {os.path.basename(file_path)}")
+            try:
+                future = pool.submit(helpers.crop_and_resize_image_path, *instax.imageSize, file_path)
+            except BrokenProcessPool:
+                # A worker died, the pool can't be used anymore
+                print("Image worker crashed, restarting the workers.", file=sys.stderr)
+                pool = restart_pool(pool, max_workers, in_flight, instax.imageSize)
+                future = pool.submit(helpers.crop_and_resize_image_path, *instax.imageSize, file_path)
+            in_flight.append((file_path, future))
 
     except KeyboardInterrupt:
         # This block executes when the user presses Ctrl-C
         print("\nTermination signal (Ctrl-C) received. Exiting gracefully.")
         return 0  # Return success code
+    finally:
+        if observer is not None:
+            observer.stop()
+            if observer.is_alive():
+                observer.join()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        instax.disconnect()
 
 
 # --- Script Entry Point ---